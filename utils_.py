@@ -7,6 +7,8 @@ from bs4 import BeautifulSoup
 from tqdm import tqdm
 import sys
 import numpy as np
+import tempfile
+import heapq
 
 
 def get_links_that_contain(regexp, html):
@@ -145,178 +147,343 @@ def INERentalDistributionAtlas(municipality_code=None):
         "Sections": sections
     })
 
-def INEPopulationAnualCensus():
+def ine_population_anual_census_years():
 
-    os.makedirs('data/INEPopulationAnualCensus', exist_ok=True)
-    filename = "data/INEPopulationAnualCensus/df.tsv"
+    print("Reading the metadata to gather the INE population and household anual census", file=sys.stdout)
+    base_link = "https://www.ine.es/dynt3/inebase/es/index.htm"
+    sections_link = "?padre=10358"
+    req = requests.get(f"{base_link}{sections_link}", headers={'User-Agent': 'Chrome/51.0.2704.103'})
+    sections_link = get_links_that_contain("capsel", req.text)[-1]
+    req = requests.get(f"{base_link}{sections_link}",headers={'User-Agent': 'Chrome/51.0.2704.103'})
+    urls = get_links_that_contain("capsel", req.text)
+    urls = urls[urls.index(sections_link)+1:]
+    g_ids = []
 
-    if not os.path.exists(filename):
+    for url in urls:
+        req = requests.get(f'{base_link}{url}',headers={'User-Agent': 'Mozilla/5'})
+        x = [re.search(r'(tpx=)(?P<x>\w+)(&L)', link).group('x') for link in
+             get_links_that_contain("Export", req.text)]
+        g_ids.append(x)
 
-        print("Reading the metadata to gather the INE population and household anual census", file=sys.stdout)
-        base_link = "https://www.ine.es/dynt3/inebase/es/index.htm"
-        sections_link = "?padre=10358"
-        req = requests.get(f"{base_link}{sections_link}", headers={'User-Agent': 'Chrome/51.0.2704.103'})
-        sections_link = get_links_that_contain("capsel", req.text)[-1]
-        req = requests.get(f"{base_link}{sections_link}",headers={'User-Agent': 'Chrome/51.0.2704.103'})
-        urls = get_links_that_contain("capsel", req.text)
-        urls = urls[urls.index(sections_link)+1:]
-        g_ids = []
+    g_urls = [[f"https://www.ine.es/jaxi/files/tpx/es/csv_bd/{id}.csv?nocab=1" for id in ids] for ids in g_ids]
+    year = 2021
+
+    for urls in tqdm(g_urls, desc="Downloading files from INE by year..."):
+
+        df = pd.DataFrame()
 
         for url in urls:
-            req = requests.get(f'{base_link}{url}',headers={'User-Agent': 'Mozilla/5'})
-            x = [re.search(r'(tpx=)(?P<x>\w+)(&L)', link).group('x') for link in
-                 get_links_that_contain("Export", req.text)]
-            g_ids.append(x)
 
-        g_urls = [[f"https://www.ine.es/jaxi/files/tpx/es/csv_bd/{id}.csv?nocab=1" for id in ids] for ids in g_ids]
-        g_df = pd.DataFrame()
-        year = 2021
+            r = requests.get(url)
+            r.encoding = 'utf-8'
+            df_ = pd.read_csv(StringIO(r.text), sep="\t", encoding="utf-8", dtype={3:'str',6:'str'})
 
-        for urls in tqdm(g_urls, desc="Downloading files from INE by year..."):
+            cols = df_.columns
+            if all([col in cols for col in ['Total Nacional', 'Provincias', 'Municipios', 'Secciones']]):
+                df_['Provincias'] = df_['Provincias'].fillna(df_['Total Nacional'])
+                df_['Municipios'] = df_['Municipios'].fillna(df_['Provincias'])
+                df_['Secciones'] = df_['Secciones'].fillna(df_['Municipios'])
+                df_ = df_.drop(columns = ['Total Nacional', 'Provincias', 'Municipios'])
+                cols = df_.columns
 
-            df = pd.DataFrame()
+            allcols = {
+                "Sección censal": "Location",
+                "Secciones": "Location",
+                "Sexo": "Sex",
+                "Lugar de nacimiento (España/extranjero)": "Place of birth",
+                "Nacionalidad (española/extranjera)": "Nationality",
+                "Relación entre lugar de nacimiento y lugar de residencia": "Detailed place of birth",
+                "Total": "Value",
+                "Edad (grupos quinquenales)": "Age"
+            }
+
+            df_ = df_.rename(columns={col:allcols[col] for col in cols})
+            cols = df_.columns
+
+            if "Sex" in cols:
+                df_["Sex"] = df_["Sex"].replace({
+                    "Hombre": "Males",
+                    "Mujer": "Females",
+                    "Ambos sexos": "Total"
+                })
 
-            for url in urls:
+            if "Place of birth" in cols:
+                df_["Place of birth"] = df_["Place of birth"].replace({
+                    "España": "Spain",
+                    "Extranjero": "Foreign country"
+                })
 
-                r = requests.get(url)
-                r.encoding = 'utf-8'
-                df_ = pd.read_csv(StringIO(r.text), sep="\t", encoding="utf-8", dtype={3:'str',6:'str'})
+            if "Nationality" in cols:
+                df_["Nationality"] = df_["Nationality"].replace({
+                    "Española": "Spanish",
+                    "Extranjera": "Foreign"
+                })
 
-                cols = df_.columns
-                if all([col in cols for col in ['Total Nacional', 'Provincias', 'Municipios', 'Secciones']]):
-                    df_['Provincias'] = df_['Provincias'].fillna(df_['Total Nacional'])
-                    df_['Municipios'] = df_['Municipios'].fillna(df_['Provincias'])
-                    df_['Secciones'] = df_['Secciones'].fillna(df_['Municipios'])
-                    df_ = df_.drop(columns = ['Total Nacional', 'Provincias', 'Municipios'])
-                    cols = df_.columns
-
-                allcols = {
-                    "Sección censal": "Location",
-                    "Secciones": "Location",
-                    "Sexo": "Sex",
-                    "Lugar de nacimiento (España/extranjero)": "Place of birth",
-                    "Nacionalidad (española/extranjera)": "Nationality",
-                    "Relación entre lugar de nacimiento y lugar de residencia": "Detailed place of birth",
-                    "Total": "Value",
-                    "Edad (grupos quinquenales)": "Age"
-                }
-
-                df_ = df_.rename(columns={col:allcols[col] for col in cols})
-                cols = df_.columns
+            if "Detailed place of birth" in cols:
+                df_["Detailed place of birth"] = df_["Detailed place of birth"].replace({
+                    "Mismo municipio": "Born in the same municipality",
+                    "Distinto municipio de la misma provincia": "Born in a municipality of the same province",
+                    "Distinta provincia de la misma comunidad": "Born in a municipality of the same autonomous community",
+                    "Distinta comunidad": "Born in a municipality of another autonomous community",
+                    "Nacido en el extranjero": "Born in another country"
+                })
 
-                if "Sex" in cols:
-                    df_["Sex"] = df_["Sex"].replace({
-                        "Hombre": "Males",
-                        "Mujer": "Females",
-                        "Ambos sexos": "Total"
-                    })
+            if "Age" in cols:
+                df_["Age"] = df_["Age"].str.replace("De ","").\
+                    str.replace(" años","").\
+                    str.replace(" a ","-").\
+                    str.replace(" y más","").\
+                    str.replace("100",">99")
+
+            df_["Year"] = year
+            df_["Value name"] = "Population"
+            df_["Value"] = pd.to_numeric(df_["Value"].astype(str).str.replace(',', '').str.replace('.', ''), errors="coerce")
+
+            df_ = pd.pivot(df_,
+                           index=[col for col in df_.columns if col in
+                                  ['Location', 'Year']],
+                           columns=[col for col in df_.columns if col not in
+                                    ['Location', 'Year', 'Value']],
+                           values="Value")
+
+            subgroups = ["Nationality", "Age", "Sex", "Place of birth", "Detailed place of birth"]
+            if isinstance(df_.columns, pd.MultiIndex):
+                allcols = df_.columns.names
+                maincol = [col for col in allcols if col not in subgroups]
+                maincol.extend([col for col in allcols if col in subgroups])
+                df_.columns = df_.columns.reorder_levels(order=maincol)
+                df_.columns = [" ~ ".join([f"{level}:{value}" if level in subgroups else f"{value}"
+                                           for level, value in zip(df_.columns.names, cols)])
+                               if cols[1]!='' else cols[0] for cols in df_.columns.to_flat_index()]
+            df_.columns = [cols.strip() for cols in df_.columns]
+
+            for subgroup in subgroups:
+                df_.columns = [re.sub(f" ~ {subgroup}:Total","", cols) for cols in df_.columns]
+
+            df_ = df_.reset_index()
+
+            if len(df)>0:
+                df = pd.merge(df,df_[[col for col in df_.columns if col not in df.columns or col=="Location"]],
+                              on="Location")
+            else:
+                df = df_
 
-                if "Place of birth" in cols:
-                    df_["Place of birth"] = df_["Place of birth"].replace({
-                        "España": "Spain",
-                        "Extranjero": "Foreign country"
-                    })
+        yield df
+        year = year + 1
 
-                if "Nationality" in cols:
-                    df_["Nationality"] = df_["Nationality"].replace({
-                        "Española": "Spanish",
-                        "Extranjera": "Foreign"
-                    })
 
-                if "Detailed place of birth" in cols:
-                    df_["Detailed place of birth"] = df_["Detailed place of birth"].replace({
-                        "Mismo municipio": "Born in the same municipality",
-                        "Distinto municipio de la misma provincia": "Born in a municipality of the same province",
-                        "Distinta provincia de la misma comunidad": "Born in a municipality of the same autonomous community",
-                        "Distinta comunidad": "Born in a municipality of another autonomous community",
-                        "Nacido en el extranjero": "Born in another country"
-                    })
+def ine_population_anual_census_codes(g_df):
 
-                if "Age" in cols:
-                    df_["Age"] = df_["Age"].str.replace("De ","").\
-                        str.replace(" años","").\
-                        str.replace(" a ","-").\
-                        str.replace(" y más","").\
-                        str.replace("100",">99")
+    g_df["Country code"] = "ES"
+    g_df["Location"] = g_df["Location"].replace({"Total Nacional":""})
+    g_df["Province code"] = np.where(g_df["Location"].str[0].apply(is_number), g_df["Location"].str[0:2], np.nan)
+    g_df["Municipality code"] = np.where(g_df["Location"].str[2].apply(is_number), g_df["Location"].str[0:5], np.nan)
+    g_df["District code"] = np.where(g_df["Location"].str[5].apply(is_number), g_df["Location"].str[5:7], np.nan)
+    g_df["Section code"] = np.where(g_df["Location"].str[7].apply(is_number), g_df["Location"].str[7:10], np.nan)
+    g_df = g_df.drop(columns=["Location"])
+
+    return g_df
+
+
+def ine_population_anual_census_districts(g_df):
+
+    return g_df.groupby(["Country code", "Province code", "Municipality code", "District code", "Year"])[
+        [col for col in g_df.columns if col not in ["Country code", "Province code", "Municipality code", "District code", "Year","Section code"]]
+        ].sum()
+
+
+def ine_population_anual_census_districts_reset(district):
+
+    # Empty codes with the same dtype read_csv(dtype=str) gives, so the section rows keep their string codes
+    district["Section code"] = pd.Series(index=district.index, dtype=str)
+    district = district.set_index("Section code", append=True)
+    district = district.reset_index()
+
+    return district
+
+
+def ine_population_anual_census_common_dtype(a, b):
+
+    # Same dtype promotion pd.concat applies when appending the years
+    return pd.concat([pd.Series(dtype=a), pd.Series(dtype=b)]).dtype
+
+
+def ine_population_anual_census_district_key(line):
+
+    # Country, province, municipality and district codes plus the year: the first columns of the district rows
+    fields = line.split("\t", 5)
+    return (fields[0], fields[1], fields[2], fields[3], int(fields[4]))
+
+
+def INEPopulationAnualCensusOutOfCore(filename, max_memory_mb=1024):
+
+    # Every year is spilled to disk as soon as it is downloaded. Afterwards, the years are loaded back
+    # in batches, the district roll-up is computed for each batch and the rows are appended to the output
+    # file. As Year is one of the roll-up keys, the partial district sums of different batches never
+    # overlap: each batch writes its sorted district rows to a file, and all of them are merged line by
+    # line at the end to match the order of the in-memory path.
+    # A batch (code columns included) takes at most half of max_memory_mb, as pd.concat needs a second
+    # copy of it. One year is the smallest unit: a year is always downloaded and processed as a whole,
+    # even if it does not fit in max_memory_mb.
+    max_memory = max_memory_mb * 1024 ** 2
+    tmp_filename = f"{filename}.tmp"
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(filename)) as parts_dir:
+        try:
+            columns = None
+            dtypes = {}
+            parts = []
+
+            for df in ine_population_anual_census_years():
+                if columns is None:
+                    columns = df.columns
+                df = ine_population_anual_census_codes(df[columns])
+                # pd.concat upcasts to a common dtype across years, so the same cast is applied to every part
+                for col, dtype in df.dtypes.items():
+                    dtypes[col] = ine_population_anual_census_common_dtype(dtypes[col], dtype) if col in dtypes else dtype
+                parts.append(f"{parts_dir}/year_{len(parts)}.pkl")
+                df.to_pickle(parts[-1])
+                del(df)
+
+            district_parts = []
+            header = True
+
+            def flush(batch):
+                nonlocal header
+                g_df = pd.concat(batch)
+                batch.clear()
+                district = ine_population_anual_census_districts(g_df)
+                district = ine_population_anual_census_districts_reset(district)
+                district_parts.append(f"{parts_dir}/district_{len(district_parts)}.tsv")
+                district.to_csv(district_parts[-1], sep="\t", index=False, header=False)
+                columns = district.columns
+                del(district)
+                g_df.to_csv(tmp_filename, sep="\t", index=False, columns=columns, header=header,
+                            mode="w" if header else "a")
+                header = False
+
+            batch = []
+            batch_memory = 0
+            for part in tqdm(parts, desc="Aggregating the INE population census by chunks..."):
+                df = pd.read_pickle(part)
+                for col, dtype in dtypes.items():
+                    if df[col].dtype != dtype:
+                        df[col] = df[col].astype(dtype)
+                df_memory = df.memory_usage(deep=True).sum()
+                if len(batch) > 0 and batch_memory + df_memory > max_memory // 2:
+                    flush(batch)
+                    batch_memory = 0
+                batch.append(df)
+                batch_memory += df_memory
+                del(df)
+            if len(batch) > 0:
+                flush(batch)
+
+            district_files = [open(part, encoding="utf-8") for part in district_parts]
+            try:
+                with open(tmp_filename, "a", encoding="utf-8") as f:
+                    f.writelines(heapq.merge(*district_files, key=ine_population_anual_census_district_key))
+            finally:
+                for district_file in district_files:
+                    district_file.close()
+
+            os.replace(tmp_filename, filename)
+
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+
+def ine_population_anual_census_levels(g_df):
 
-                df_["Year"] = year
-                df_["Value name"] = "Population"
-                df_["Value"] = pd.to_numeric(df_["Value"].astype(str).str.replace(',', '').str.replace('.', ''), errors="coerce")
+    # national = g_df[pd.isna(g_df["Province code"]) & pd.isna(g_df["Municipality code"]) & pd.isna(g_df["District code"]) & pd.isna(g_df["Section code"])]
+    # province = g_df[-pd.isna(g_df["Province code"]) & pd.isna(g_df["Municipality code"]) & pd.isna(g_df["District code"]) & pd.isna(g_df["Section code"])]
+    municipality = g_df[-pd.isna(g_df["Province code"]) & -pd.isna(g_df["Municipality code"]) & pd.isna(g_df["District code"]) & pd.isna(g_df["Section code"])]
+    districts = g_df[-pd.isna(g_df["Province code"]) & -pd.isna(g_df["Municipality code"]) & -pd.isna(g_df["District code"]) & pd.isna(g_df["Section code"])]
+    sections = g_df[-pd.isna(g_df["Province code"]) & -pd.isna(g_df["Municipality code"]) & -pd.isna(g_df["District code"]) & -pd.isna(g_df["Section code"])]
 
-                df_ = pd.pivot(df_,
-                               index=[col for col in df_.columns if col in
-                                      ['Location', 'Year']],
-                               columns=[col for col in df_.columns if col not in
-                                        ['Location', 'Year', 'Value']],
-                               values="Value")
+    return ({
+        # "National": national,
+        # "Province": province,
+        "Municipality": municipality,
+        "Districts": districts,
+        "Sections": sections
+    })
 
-                subgroups = ["Nationality", "Age", "Sex", "Place of birth", "Detailed place of birth"]
-                if isinstance(df_.columns, pd.MultiIndex):
-                    allcols = df_.columns.names
-                    maincol = [col for col in allcols if col not in subgroups]
-                    maincol.extend([col for col in allcols if col in subgroups])
-                    df_.columns = df_.columns.reorder_levels(order=maincol)
-                    df_.columns = [" ~ ".join([f"{level}:{value}" if level in subgroups else f"{value}"
-                                               for level, value in zip(df_.columns.names, cols)])
-                                   if cols[1]!='' else cols[0] for cols in df_.columns.to_flat_index()]
-                df_.columns = [cols.strip() for cols in df_.columns]
 
-                for subgroup in subgroups:
-                    df_.columns = [re.sub(f" ~ {subgroup}:Total","", cols) for cols in df_.columns]
+ine_population_anual_census_dtypes = {
+    "Province code": str,
+    "Municipality code": str,
+    "District code": str,
+    "Section code": str
+}
 
-                df_ = df_.reset_index()
 
-                if len(df)>0:
-                    df = pd.merge(df,df_[[col for col in df_.columns if col not in df.columns or col=="Location"]],
-                                  on="Location")
-                else:
-                    df = df_
+def ine_population_anual_census_chunks(filename, level, columns, chunksize):
+
+    for chunk in pd.read_csv(filename, sep="\t", dtype=ine_population_anual_census_dtypes, chunksize=chunksize):
+        df = ine_population_anual_census_levels(chunk)[level]
+        del(chunk)
+        if len(df) > 0:
+            yield df[columns]
+
 
-            year = year + 1
+def INEPopulationAnualCensus(out_of_core=False, max_memory_mb=1024):
+
+    os.makedirs('data/INEPopulationAnualCensus', exist_ok=True)
+    filename = "data/INEPopulationAnualCensus/df.tsv"
+
+    if out_of_core:
+
+        if not os.path.exists(filename):
+            INEPopulationAnualCensusOutOfCore(filename, max_memory_mb=max_memory_mb)
+
+        # Each level is returned as a generator of DataFrames read by chunks from df.tsv, so memory stays
+        # bounded by max_memory_mb. A chunk takes at most a quarter of it, leaving room for the parser and
+        # the level and column selections. Concatenating the chunks gives the in-memory result.
+        sample = pd.read_csv(filename, sep="\t", dtype=ine_population_anual_census_dtypes, nrows=1000)
+        row_memory = max(1, sample.memory_usage(deep=True).sum() // max(1, len(sample)))
+        chunksize = max(1, int(max_memory_mb * 1024 ** 2) // 4 // row_memory)
+        file_columns = sample.columns
+        del(sample)
+
+        # First pass to find the columns with values at each level
+        columns = {}
+        for chunk in pd.read_csv(filename, sep="\t", dtype=ine_population_anual_census_dtypes, chunksize=chunksize):
+            for level, df in ine_population_anual_census_levels(chunk).items():
+                columns.setdefault(level, set()).update(df.columns[df.notna().any()])
+            del(chunk)
+
+        return ({
+            level: ine_population_anual_census_chunks(
+                filename, level, [col for col in file_columns if col in level_columns], chunksize)
+            for level, level_columns in columns.items()
+        })
+
+    if not os.path.exists(filename):
+
+        g_df = pd.DataFrame()
+
+        for df in ine_population_anual_census_years():
             if len(g_df)>0:
                 g_df = pd.concat([g_df,df[g_df.columns]])
             else:
                 g_df = df
 
-        g_df["Country code"] = "ES"
-        g_df["Location"] = g_df["Location"].replace({"Total Nacional":""})
-        g_df["Province code"] = np.where(g_df["Location"].str[0].apply(is_number), g_df["Location"].str[0:2], np.nan)
-        g_df["Municipality code"] = np.where(g_df["Location"].str[2].apply(is_number), g_df["Location"].str[0:5], np.nan)
-        g_df["District code"] = np.where(g_df["Location"].str[5].apply(is_number), g_df["Location"].str[5:7], np.nan)
-        g_df["Section code"] = np.where(g_df["Location"].str[7].apply(is_number), g_df["Location"].str[7:10], np.nan)
-        g_df = g_df.drop(columns=["Location"])
-
-        district = g_df.groupby(["Country code", "Province code", "Municipality code", "District code", "Year"])[
-            [col for col in g_df.columns if col not in ["Country code", "Province code", "Municipality code", "District code", "Year","Section code"]]
-            ].sum()
-        district["Section code"] = np.nan
-        district = district.set_index("Section code", append=True)
-        district = district.reset_index()
-        g_df = pd.concat([g_df[district.columns], district])
+        g_df = ine_population_anual_census_codes(g_df)
+        district = ine_population_anual_census_districts(g_df)
+        district = ine_population_anual_census_districts_reset(district)
+        g_df = pd.concat([g_df[district.columns], district], ignore_index=True)
 
         g_df.to_csv(filename,sep="\t", index=False)
 
     else:
-        g_df = pd.read_csv(filename, sep="\t")
+        g_df = pd.read_csv(filename, sep="\t", dtype=ine_population_anual_census_dtypes)
 
-    # national = g_df[pd.isna(g_df["Province code"]) & pd.isna(g_df["Municipality code"]) & pd.isna(g_df["District code"]) & pd.isna(g_df["Section code"])]
-    # national = national[national.columns[national.notna().any()]]
-    # province = g_df[-pd.isna(g_df["Province code"]) & pd.isna(g_df["Municipality code"]) & pd.isna(g_df["District code"]) & pd.isna(g_df["Section code"])]
-    # province = province[province.columns[province.notna().any()]]
-    municipality = g_df[-pd.isna(g_df["Province code"]) & -pd.isna(g_df["Municipality code"]) & pd.isna(g_df["District code"]) & pd.isna(g_df["Section code"])]
-    municipality = municipality[municipality.columns[municipality.notna().any()]]
-    districts = g_df[-pd.isna(g_df["Province code"]) & -pd.isna(g_df["Municipality code"]) & -pd.isna(g_df["District code"]) & pd.isna(g_df["Section code"])]
-    districts = districts[districts.columns[districts.notna().any()]]
-    sections = g_df[-pd.isna(g_df["Province code"]) & -pd.isna(g_df["Municipality code"]) & -pd.isna(g_df["District code"]) & -pd.isna(g_df["Section code"])]
-    sections = sections[sections.columns[sections.notna().any()]]
+    levels = ine_population_anual_census_levels(g_df)
+    del(g_df)
 
-    return ({
-        # "National": national,
-        # "Province": province,
-        "Municipality": municipality,
-        "Districts": districts,
-        "Sections": sections
-    })
+    return ({level: df[df.columns[df.notna().any()]] for level, df in levels.items()})
 
 
 def RelationAutonomousCommunityAndProvince():
@@ -447,22 +614,139 @@ def INEEssentialCharacteristicsOfPopulationAndHouseholds():
     "https://www.ine.es/dyngs/INEbase/es/operacion.htm?c=Estadistica_C&cid=1254736177092&menu=resultados&idp=1254735572981"
 
 
-def INECensus2021():
-    # Indicadores de distribución de consumo eléctrico
-    r = requests.get("https://www.ine.es/jaxi/files/tpx/es/csv_bd/59532.csv?nocab=1")
-    r.encoding = 'utf-8'
-    df_ = pd.read_csv(StringIO(r.text), sep="\t", encoding="utf-8", dtype={3: 'str', 6: 'str'})
+def INECensus2021Matrix():
+
+    os.makedirs('data/INECensus2021', exist_ok=True)
+    filename = "data/INECensus2021/values.npy"
+    sections_filename = "data/INECensus2021/sections.tsv"
+    indicators_filename = "data/INECensus2021/indicators.tsv"
+
+    if not (os.path.exists(filename) and os.path.exists(sections_filename) and os.path.exists(indicators_filename)):
+
+        print("Downloading the INE Census 2021 indicators at section level", file=sys.stdout)
+
+        # Todos los indicadores disponibles a nivel sección censal
+        # (definiciones en https://www.ine.es/censos2021/indicadores_seccen_c2021.xlsx)
+        r = requests.get("https://www.ine.es/censos2021/C2021_Indicadores.csv")
+        r.encoding = 'utf-8'
+        df = pd.read_csv(StringIO(r.text), sep=",", encoding="utf-8", dtype=str)
+        df.columns = [col.strip() for col in df.columns]
+        code_cols = {col.lower(): col for col in df.columns if col.lower() in ["ccaa", "cpro", "cmun", "dist", "secc"]}
+        df["Location"] = df[code_cols["cpro"]].str.zfill(2) + df[code_cols["cmun"]].str.zfill(3) + \
+                         df[code_cols["dist"]].str.zfill(2) + df[code_cols["secc"]].str.zfill(3)
+        df = df.drop(columns=list(code_cols.values()))
+        df = df.set_index("Location")
+        df = df.apply(lambda x: pd.to_numeric(x.str.replace(',', '.'), errors="coerce"))
+        df = df[df.columns[df.notna().any()]]
+
+        # Indicadores de distribución de consumo eléctrico
+        r = requests.get("https://www.ine.es/jaxi/files/tpx/es/csv_bd/59532.csv?nocab=1")
+        r.encoding = 'utf-8'
+        df_ = pd.read_csv(StringIO(r.text), sep="\t", encoding="utf-8", dtype=str)
+
+        cols = df_.columns
+        if all([col in cols for col in ['Total Nacional', 'Provincias', 'Municipios', 'Secciones']]):
+            df_['Provincias'] = df_['Provincias'].fillna(df_['Total Nacional'])
+            df_['Municipios'] = df_['Municipios'].fillna(df_['Provincias'])
+            df_['Secciones'] = df_['Secciones'].fillna(df_['Municipios'])
+            df_ = df_.drop(columns=['Total Nacional', 'Provincias', 'Municipios'])
+        df_ = df_.rename(columns={"Secciones": "Location", "Sección censal": "Location", "Total": "Value"})
+        df_["Location"] = df_["Location"].astype(str).str[:10]
+        df_ = df_[df_["Location"].str.fullmatch(r"\d{10}")]
+        df_["Value"] = pd.to_numeric(df_["Value"].astype(str).str.replace('.', '').str.replace(',', '.'),
+                                     errors="coerce")
+        df_ = pd.pivot_table(df_,
+                             index="Location",
+                             columns=[col for col in df_.columns if col not in ["Location", "Value"]],
+                             values="Value",
+                             aggfunc="first")
+        if isinstance(df_.columns, pd.MultiIndex):
+            df_.columns = [" ~ ".join([str(value) for value in cols]) for cols in df_.columns.to_flat_index()]
+        df_.columns = [str(cols).strip() for cols in df_.columns]
+
+        df = df.join(df_[[col for col in df_.columns if col not in df.columns]], how="outer")
+        df = df.sort_index()
+        del(df_)
+
+        # Sections x indicators matrix, stored as a .npy file to be memory-mapped when read.
+        # The three files are written to temporary names and only published once all of them are complete.
+        try:
+            values = np.lib.format.open_memmap(f"{filename}.tmp", mode="w+", dtype=np.float64, shape=df.shape)
+            values[:] = df.to_numpy(dtype=np.float64, na_value=np.nan)
+            values.flush()
+            del(values)
+            pd.DataFrame({"Location": df.index}).to_csv(f"{sections_filename}.tmp", sep="\t", index=False)
+            pd.DataFrame({"Indicator": df.columns}).to_csv(f"{indicators_filename}.tmp", sep="\t", index=False)
+            os.replace(f"{sections_filename}.tmp", sections_filename)
+            os.replace(f"{indicators_filename}.tmp", indicators_filename)
+            os.replace(f"{filename}.tmp", filename)
+        finally:
+            for tmp_filename in [f"{filename}.tmp", f"{sections_filename}.tmp", f"{indicators_filename}.tmp"]:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+        del(df)
+
+    values = np.load(filename, mmap_mode="c")
+    sections = pd.Index(pd.read_csv(sections_filename, sep="\t", dtype=str)["Location"].to_numpy(), name=None)
+    indicators = pd.Index(pd.read_csv(indicators_filename, sep="\t", dtype=str, keep_default_na=False)["Indicator"].to_numpy(),
+                          name=None)
+
+    return ({
+        "Values": values,
+        "Sections": sections,
+        "Indicators": indicators
+    })
+
 
-    cols = df_.columns
+def INECensus2021(municipality_code=None, section_code=None, indicators=None):
 
-    # Todos los indicadores disponibles a nivel sección censal
-    r = requests.get("https://www.ine.es/censos2021/C2021_Indicadores.csv")
-    r.encoding = 'utf-8'
-    df_ = pd.read_csv(StringIO(r.text), sep=",", encoding="utf-8", dtype={3: 'str', 6: 'str'})
+    matrix = INECensus2021Matrix()
+    values = matrix["Values"]
+    sections = matrix["Sections"]
 
-    cols = df_.columns
+    rows = slice(None)
+    if municipality_code is not None:
+        if type(municipality_code) == str:
+            municipality_code = [municipality_code]
+        rows = np.flatnonzero(sections.str[:5].isin(municipality_code))
+    if section_code is not None:
+        if type(section_code) == str:
+            section_code = [section_code]
+        section_rows = sections.get_indexer(section_code)
+        if (section_rows < 0).any():
+            raise KeyError(f"Unknown INE Census 2021 sections: {[s for s, r in zip(section_code, section_rows) if r < 0]}")
+        rows = section_rows if isinstance(rows, slice) else section_rows[np.isin(section_rows, rows)]
+    if not isinstance(rows, slice):
+        sections = sections[rows]
+
+    cols = slice(None)
+    if indicators is not None:
+        if type(indicators) == str:
+            indicators = [indicators]
+        cols = matrix["Indicators"].get_indexer(indicators)
+        if (cols < 0).any():
+            raise KeyError(f"Unknown INE Census 2021 indicators: {[i for i, c in zip(indicators, cols) if c < 0]}")
+    indicators = matrix["Indicators"][cols]
+
+    # Only the selected rows and columns are read from the memory-mapped matrix
+    if isinstance(rows, slice) and isinstance(cols, slice):
+        df = pd.DataFrame(values, columns=indicators, copy=False)
+    elif isinstance(rows, slice):
+        df = pd.DataFrame(values[:, cols], columns=indicators)
+    elif isinstance(cols, slice):
+        df = pd.DataFrame(values[rows], columns=indicators)
+    else:
+        df = pd.DataFrame(values[np.ix_(rows, cols)], columns=indicators)
 
-    "https://www.ine.es/censos2021/indicadores_seccen_c2021.xlsx"
+    df.insert(0, "Country code", "ES")
+    df.insert(1, "Province code", sections.str[0:2])
+    df.insert(2, "Municipality code", sections.str[0:5])
+    df.insert(3, "District code", sections.str[5:7])
+    df.insert(4, "Section code", sections.str[7:10])
+
+    return ({
+        "Sections": df
+    })
 
 
 def INEHouseholdsRentalPriceIndex():